@@ -1,11 +1,14 @@
+import numpy as np
 import pandas as pd
-import folium
-from branca.colormap import LinearColormap
-from streamlit_folium import st_folium
+from pandas.api.types import union_categoricals
 import streamlit as st
-import altair as alt
+import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import os
+import tempfile
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
 
@@ -53,33 +56,166 @@ def fetch_arcgis_layer(layer_id: int, out_fields: str = "*", page_size: int = 20
     return pd.DataFrame(all_rows)
 
 
+# ---------------------------------------------------------------------------
+# Helper: Parquet snapshots so cold starts skip the download / Excel parse
+# ---------------------------------------------------------------------------
+GOV_TTL = 6 * 3600
+# Part of every snapshot file name: bump it whenever either loader's output
+# changes, so snapshots written by older code are never read back
+SNAPSHOT_VERSION = 4
+SNAPSHOT_SUFFIX = f".v{SNAPSHOT_VERSION}.parquet"
+GOV_SNAPSHOT = "government_data" + SNAPSHOT_SUFFIX
+CATEGORY_COLUMNS = ("Site_Description", "Result_Name", "Units")
+# Coordinates only: cell counts exceed float32's 2**24 exact-integer range
+FLOAT32_COLUMNS = ("Latitude", "Longitude")
+# df.attrs key identifying one load (download time or snapshot mtime)
+LOAD_TOKEN = "load_token"
+
+
+def compact_dtypes(df):
+    """
+    Store the repeated text columns as pandas categoricals and the
+    coordinates as float32 (half the memory of float64).
+    """
+    for c in CATEGORY_COLUMNS:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+    for c in FLOAT32_COLUMNS:
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce").astype("float32")
+    return df
+
+
+def read_snapshot(path, newer_than):
+    """
+    Return the Parquet snapshot at `path` if it was written after
+    `newer_than` (POSIX timestamp) and holds data, otherwise None.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+        if mtime > newer_than:
+            snapshot = pd.read_parquet(path, engine="pyarrow")
+            if not snapshot.empty:
+                snapshot.attrs[LOAD_TOKEN] = mtime
+                return snapshot
+    except Exception:
+        pass
+    return None
+
+
+def write_snapshot(df, path):
+    """
+    Write `df` to a temporary file beside `path` and move it into place,
+    so concurrent readers never see a half-written snapshot.
+    """
+    if df.empty:
+        # Never persist an empty download past this process
+        return
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+        os.close(fd)
+        df.to_parquet(tmp, engine="pyarrow", compression="zstd", index=False)
+        os.replace(tmp, path)
+    except Exception:
+        # Read-only disk or a column pyarrow can't encode: run without a snapshot
+        if tmp is not None:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+
+def format_sample_time(value):
+    """
+    Excel fractional day → HH:MM; anything else is shown as-is.
+    """
+    try:
+        total_minutes = int(float(value) * 1440)
+        return f"{total_minutes // 60:02d}:{total_minutes % 60:02d}"
+    except Exception:
+        return str(value)
+
+
+def factorize_text(series):
+    """
+    Codes and distinct values of `series` as text, matching what
+    astype(str) gives per row: nulls keep their own text ("None" / "nan")
+    instead of pd.factorize folding them into one NaN.
+    """
+    values = series.to_numpy(dtype=object, copy=True)
+    nulls = pd.isna(values)
+    values[nulls] = values[nulls].astype(str)
+    codes, uniques = pd.factorize(values)
+    return codes, pd.Series(uniques.astype(str))
+
+
+# ---------------------------------------------------------------------------
+# Site coordinates from ArcGIS layer 0 (sites change far less than samples)
+# ---------------------------------------------------------------------------
+SITES_TTL = 24 * 3600
+
+
+def clean_site(series):
+    """
+    Normalised site name used to join samples to site coordinates.
+    """
+    return (
+        series.astype(str)
+        .str.strip()
+        .str.replace("\xa0", " ", regex=False)
+        .str.replace("’", "'", regex=False)
+        .str.replace("‘", "'", regex=False)
+        .str.replace(r"\s+", " ", regex=True)
+        .str.lower()
+    )
+
+
+@st.cache_data(ttl=SITES_TTL, show_spinner=False)
+def load_sites():
+    """
+    Latitude/Longitude per cleaned site key, cached on its own so a new
+    sample download doesn't refetch the site layer.
+    """
+    # Only the fields used below are requested from the server, plus
+    # OBJECTID, which the paginated query orders by
+    sites = fetch_arcgis_layer(layer_id=0, out_fields="OBJECTID,SiteName,Latitude,Longitude")
+    sites = sites.rename(columns={"SiteName": "Site_Description"})
+    sites["site_key"] = clean_site(sites["Site_Description"])
+
+    return (
+        sites[["site_key", "Latitude", "Longitude"]]
+        .dropna(subset=["Latitude", "Longitude"])
+        .drop_duplicates(subset=["site_key"])
+        .set_index("site_key")
+    )
+
+
 # ---------------------------------------------------------------------------
 # Load government data from ArcGIS (auto-refreshes every 6 hours)
 # ---------------------------------------------------------------------------
-@st.cache_data(ttl=6 * 3600)
-def load_data():
+@st.cache_data(ttl=GOV_TTL, show_spinner=False)
+def load_data(refresh_window, snapshot_path=GOV_SNAPSHOT):
+    # `refresh_window` is int(time.time() // GOV_TTL): the cache entry and a
+    # snapshot from a previous server process share the same 6-hour window
+    snapshot = read_snapshot(snapshot_path, newer_than=refresh_window * GOV_TTL)
+    if snapshot is not None:
+        return snapshot
+
     # Sample results (table 1)
     df = fetch_arcgis_layer(layer_id=1)
 
-    # Site coordinates (layer 0)
-    sites = fetch_arcgis_layer(layer_id=0)
-    sites = sites.rename(columns={"SiteName": "Site_Description"})
-
     # ------------------------------------------------------------------
     # Cleaning (same logic as original)
     # ------------------------------------------------------------------
     df.columns = df.columns.str.strip()
     df["Date_Sample_Collected"] = pd.to_datetime(df["Date_Sample_Collected"], errors="coerce")
+    if "Time" in df.columns:
+        # Formatted once here, as in load_community, not on every map render
+        df["Time"] = df["Time"].where(df["Time"].isna(), df["Time"].map(format_sample_time))
 
-    # Clean Result_Name
-    df["Result_Name"] = (
-        df["Result_Name"]
-        .astype(str)
-        .str.strip()
-        .str.replace(r"\s+", " ", regex=True)
-        .str.replace("\xa0", " ")
-    )
-
+    # Clean Result_Name: only the few distinct names are cleaned, then
+    # mapped back onto the rows by their factorized codes
     karenia_standardization = {
         "Karenia sp": "Karenia sp.",
         "Karenia spp": "Karenia sp.",
@@ -87,7 +223,14 @@ def load_data():
         "Karenia spp.": "Karenia sp.",
         "Karenia spp": "Karenia sp.",
     }
-    df["Result_Name"] = df["Result_Name"].replace(karenia_standardization)
+    name_codes, raw_names = factorize_text(df["Result_Name"])
+    clean_names = (
+        raw_names.str.strip()
+        .str.replace(r"\s+", " ", regex=True)
+        .str.replace("\xa0", " ")
+        .replace(karenia_standardization)
+    )
+    df["Result_Name"] = clean_names.to_numpy()[name_codes]
 
     # Convert "Not detected" → 0 cells/L
     not_detected_mask = (
@@ -100,28 +243,17 @@ def load_data():
     df.loc[not_detected_mask, "Result_Value_Numeric"] = 0.0
     df.loc[not_detected_mask, "Result_Value_String"] = "0"
 
-    # Site cleaning + merge
-    def clean_site(series):
-        return (
-            series.astype(str)
-            .str.strip()
-            .str.replace("\xa0", " ", regex=False)
-            .str.replace("’", "'", regex=False)
-            .str.replace("‘", "'", regex=False)
-            .str.replace(r"\s+", " ", regex=True)
-            .str.lower()
-        )
-
-    df["site_key"] = clean_site(df["Site_Description"])
-    sites["site_key"] = clean_site(sites["Site_Description"])
-
-    sites = (
-        sites[["site_key", "Latitude", "Longitude"]]
-        .dropna(subset=["Latitude", "Longitude"])
-        .drop_duplicates(subset=["site_key"])
-    )
+    # Site coordinates (layer 0, cached separately)
+    sites = load_sites()
 
-    df = df.merge(sites, on="site_key", how="left")
+    # Keys and coordinates are looked up once per distinct site name and
+    # gathered onto the rows by code (same result as a left merge)
+    site_codes, raw_sites = factorize_text(df["Site_Description"])
+    site_keys = clean_site(raw_sites)
+    site_coords = sites.reindex(site_keys.to_numpy())
+    df["site_key"] = site_keys.to_numpy()[site_codes]
+    df["Latitude"] = site_coords["Latitude"].to_numpy()[site_codes]
+    df["Longitude"] = site_coords["Longitude"].to_numpy()[site_codes]
 
     # Small lat/lon offset for Bottom samples (≈220 m)
     bottom_mask = df["Site_Description"].fillna("").str.contains("bottom", case=False)
@@ -130,16 +262,50 @@ def load_data():
     df.loc[bottom_mask, "Latitude"] += OFFSET_LAT
     df.loc[bottom_mask, "Longitude"] += OFFSET_LON
 
+    # Date-sorted so the date filter can binary search (NaT sorts last)
+    df = df.sort_values("Date_Sample_Collected", kind="stable").reset_index(drop=True)
+
+    df = compact_dtypes(df)
+    df.attrs[LOAD_TOKEN] = time.time()
+    write_snapshot(df, snapshot_path)
+
     return df
 
 
-@st.cache_data
-def load_community(file_path="MASTER spreadsheet of community summaries.xlsx"):
+# ---------------------------------------------------------------------------
+# Load community data (disk-persisted; the file mtime is part of the key)
+# ---------------------------------------------------------------------------
+COMMUNITY_FILE = "MASTER spreadsheet of community summaries.xlsx"
+COMMUNITY_COLUMNS = [
+    "Site_Description",
+    "Latitude",
+    "Longitude",
+    "Date_Sample_Collected",
+    "Time",
+    "Result_Name",
+    "Result_Value_Numeric",
+    "Units",
+]
+
+
+def file_mtime(path):
+    return os.path.getmtime(path) if os.path.exists(path) else None
+
+
+@st.cache_data(persist="disk", max_entries=4, show_spinner=False)
+def load_community(file_path=COMMUNITY_FILE, mtime=None):
+    # `mtime` only keys the cache so an edited spreadsheet is re-read
     if not os.path.exists(file_path):
         st.warning(f"⚠️ Community data file '{file_path}' not found. Using empty dataset.")
         return pd.DataFrame()
 
-    df = pd.read_excel(file_path, sheet_name=0)
+    snapshot_path = file_path + SNAPSHOT_SUFFIX
+    snapshot = read_snapshot(snapshot_path, newer_than=os.path.getmtime(file_path))
+    if snapshot is not None:
+        return snapshot
+
+    # Rust-based calamine reader; much faster than openpyxl on this sheet
+    df = pd.read_excel(file_path, sheet_name=0, engine="calamine")
     df.columns = df.columns.str.strip()
 
     if "Lat" in df.columns:
@@ -151,35 +317,18 @@ def load_community(file_path="MASTER spreadsheet of community summaries.xlsx"):
         df["Date"] = pd.to_datetime(df["Date"], origin="1899-12-30", errors="coerce")
 
     if "Time" in df.columns:
+        # Mix of Excel fractions, time and datetime cells → display strings
+        df["Time"] = df["Time"].where(df["Time"].isna(), df["Time"].map(format_sample_time))
         start_idx = df.columns.get_loc("Time") + 1
     else:
         start_idx = df.columns.get_loc("Date") + 1
     total_idx = df.columns.get_loc("Total plankton")
     species_cols = df.columns[start_idx : total_idx + 1].tolist()
 
-    id_vars = ["Location", "Latitude", "Longitude", "Date"]
-    if "Time" in df.columns:
-        id_vars.append("Time")
-
-    melted_df = pd.melt(
-        df,
-        id_vars=id_vars,
-        value_vars=species_cols,
-        var_name="Result_Name",
-        value_name="Result_Value_Numeric",
-    )
-
-    melted_df["Site_Description"] = melted_df["Location"]
-    melted_df["Date_Sample_Collected"] = melted_df["Date"]
-    melted_df = melted_df.drop(["Location", "Date"], axis=1)
-
-    # cells/mL → cells/L
-    melted_df["Result_Value_Numeric"] *= 1000
-    melted_df["Units"] = "cells/L"
-
-    # Cleanup & standardisation
-    melted_df["Site_Description"] = (
-        melted_df["Site_Description"]
+    # Cleanup & standardisation, done on the wide sheet (one row per
+    # sample, one label per species) before it is reshaped
+    df["Location"] = (
+        df["Location"]
         .astype(str)
         .str.strip()
         .str.replace(r"\s+", " ", regex=True)
@@ -189,26 +338,407 @@ def load_community(file_path="MASTER spreadsheet of community summaries.xlsx"):
         "Louth Bay jetty": "Louth Bay Jetty",
         "Louth Bay Jetty": "Louth Bay Jetty",
     }
-    melted_df["Site_Description"] = melted_df["Site_Description"].replace(name_corrections)
+    df["Location"] = df["Location"].replace(name_corrections)
 
     # Important: suffix so community data does not override recent government data
-    melted_df["Site_Description"] = melted_df["Site_Description"] + " - community data"
+    df["Location"] = df["Location"] + " - community data"
 
-    melted_df["Result_Name"] = (
-        melted_df["Result_Name"]
+    species_names = (
+        pd.Index(species_cols)
         .astype(str)
         .str.strip()
         .str.replace(r"\s+", " ", regex=True)
         .str.replace("\xa0", " ", regex=False)
-    )
-    melted_df["Result_Name"] += " *"
+    ) + " *"
+
+    df["Latitude"] = pd.to_numeric(df["Latitude"], errors="coerce")
+    df["Longitude"] = pd.to_numeric(df["Longitude"], errors="coerce")
+
+    # Wide → long straight from NumPy: each sample's id values repeated
+    # once per species, species labels tiled once per sample, and the
+    # species block ravelled row-major to line up with both.
+    # (placeholder text such as "tr" or "-" becomes NaN)
+    values = df[species_cols].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+    n_species = len(species_cols)
+
+    long_cols = {
+        "Site_Description": np.repeat(df["Location"].to_numpy(), n_species),
+        "Latitude": np.repeat(df["Latitude"].to_numpy(), n_species),
+        "Longitude": np.repeat(df["Longitude"].to_numpy(), n_species),
+        "Date_Sample_Collected": np.repeat(df["Date"].to_numpy(), n_species),
+    }
+    if "Time" in df.columns:
+        long_cols["Time"] = np.repeat(df["Time"].to_numpy(), n_species)
+    long_cols["Result_Name"] = np.tile(species_names.to_numpy(), len(df))
+    # cells/mL → cells/L
+    long_cols["Result_Value_Numeric"] = values.ravel() * 1000
+    long_cols["Units"] = "cells/L"
 
-    melted_df["Latitude"] = pd.to_numeric(melted_df["Latitude"], errors="coerce")
-    melted_df["Longitude"] = pd.to_numeric(melted_df["Longitude"], errors="coerce")
+    melted_df = pd.DataFrame(long_cols)
+
+    melted_df = melted_df.sort_values("Date_Sample_Collected", kind="stable").reset_index(drop=True)
+
+    melted_df = compact_dtypes(melted_df)
+    melted_df.attrs[LOAD_TOKEN] = time.time()
+    write_snapshot(melted_df, snapshot_path)
 
     return melted_df
 
 
+def concat_categorical(frames):
+    """
+    Concatenate frames while keeping categorical columns categorical
+    (pd.concat falls back to object when the categories differ).
+    """
+    frames = list(frames)
+    if len(frames) > 1:
+        for c in CATEGORY_COLUMNS:
+            if all(c in f.columns and isinstance(f[c].dtype, pd.CategoricalDtype) for f in frames):
+                categories = union_categoricals([f[c] for f in frames]).categories
+                frames = [f.astype({c: pd.CategoricalDtype(categories)}) for f in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+# ---------------------------------------------------------------------------
+# Sidebar filter metadata (cached so widget interactions skip the full scan)
+# ---------------------------------------------------------------------------
+def sorted_union(frames, column):
+    """
+    Sorted unique values of `column` across frames, without concatenating.
+    """
+    values = np.array([], dtype=object)
+    for f in frames:
+        col = f[column]
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            # Categories are already the unique values; no column scan
+            values = np.union1d(values, col.cat.categories.to_numpy())
+        else:
+            values = np.union1d(values, col.dropna().unique())
+    return values.tolist()
+
+
+def frame_fingerprint(d):
+    """
+    Cheap cache key for a loaded frame: the load token stamped on it by the
+    loaders (plus shape, so row slices of it differ). Frames without a
+    token fall back to hashing their contents.
+    """
+    token = d.attrs.get(LOAD_TOKEN)
+    if token is not None:
+        return token, d.shape
+    return d.shape, tuple(d.columns), int(pd.util.hash_pandas_object(d, index=False).sum())
+
+
+FRAME_FINGERPRINT = {pd.DataFrame: frame_fingerprint}
+
+
+@st.cache_data(hash_funcs=FRAME_FINGERPRINT)
+def get_filter_metadata(df, community_df):
+    """
+    Sorted species list and overall date range across both frames.
+    Frames are fingerprinted, not hashed, so cache lookups stay cheap.
+    """
+    frames = [f for f in (df, community_df) if not f.empty]
+    if not frames:
+        return (), pd.to_datetime("2020-01-01"), pd.to_datetime("2030-12-31")
+
+    species = sorted_union(frames, "Result_Name")
+
+    min_date = min(f["Date_Sample_Collected"].min() for f in frames)
+    max_date = max(f["Date_Sample_Collected"].max() for f in frames)
+
+    return tuple(species), min_date, max_date
+
+
+def species_mask(frame, species):
+    """
+    Rows whose Result_Name is in `species`, compared on category codes.
+    """
+    names = frame["Result_Name"]
+    if not isinstance(names.dtype, pd.CategoricalDtype):
+        return names.isin(species).to_numpy()
+    codes = names.cat.categories.get_indexer(list(species))
+    return np.isin(names.cat.codes.to_numpy(), codes[codes >= 0])
+
+
+def date_bounds(frame, start_date, end_date):
+    """
+    Row positions [lo, hi) of a date-sorted frame with
+    start_date <= date <= end_date, located by binary search instead of
+    a full scan.
+    """
+    dates = frame["Date_Sample_Collected"].to_numpy()
+    lo = np.searchsorted(dates, pd.Timestamp(start_date).to_datetime64(), side="left")
+    hi = np.searchsorted(dates, pd.Timestamp(end_date).to_datetime64(), side="right")
+    return lo, hi
+
+
+@st.cache_resource(hash_funcs=FRAME_FINGERPRINT, max_entries=4, show_spinner=False)
+def species_index(frame):
+    """
+    Inverted index: species name -> ascending row positions in `frame`,
+    built once per loaded frame from the category codes. It is a shared
+    resource (no unpickle per rerun), so the arrays are read-only.
+    """
+    names = frame["Result_Name"]
+    if not isinstance(names.dtype, pd.CategoricalDtype):
+        names = names.astype("category")
+    codes = names.cat.codes.to_numpy()
+    order = np.argsort(codes, kind="stable")
+    order.flags.writeable = False
+    bounds = np.searchsorted(codes[order], np.arange(len(names.cat.categories) + 1))
+    return {
+        name: order[bounds[i] : bounds[i + 1]]
+        for i, name in enumerate(names.cat.categories)
+    }
+
+
+def select_samples(frame, species, start_date, end_date):
+    """
+    Rows of `frame` for the selected species within the date range. The
+    frame is date-sorted, so the window is a range of row positions and
+    each species' indexed rows are cut to it by binary search too.
+    """
+    lo, hi = date_bounds(frame, start_date, end_date)
+    index = species_index(frame)
+    parts = [
+        rows[np.searchsorted(rows, lo) : np.searchsorted(rows, hi)]
+        for rows in (index.get(s) for s in species)
+        if rows is not None
+    ]
+    rows = np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.intp)
+    return frame.iloc[rows]
+
+
+@st.cache_data(hash_funcs=FRAME_FINGERPRINT, show_spinner=False)
+def daily_rollup(frame):
+    """
+    Sum and count of measured values per (date, site, species), computed
+    once per loaded frame so the trends chart never re-aggregates raw rows.
+    """
+    measured = frame[frame["Result_Value_Numeric"].notna()]
+    return (
+        measured.groupby(
+            ["Date_Sample_Collected", "Site_Description", "Result_Name"],
+            observed=True,
+            dropna=False,
+        )["Result_Value_Numeric"]
+        .agg(["sum", "count"])
+        .reset_index()
+    )
+
+
+# Above this many (date, species) points the trend line is time-bucketed
+TREND_MAX_POINTS = 2000
+
+
+def coarsen_trend(totals):
+    """
+    Pool per-day (sum, count) totals into multi-day buckets when there are
+    more than TREND_MAX_POINTS of them; means stay exact as sum / count.
+    """
+    dates = totals.index.get_level_values("Date_Sample_Collected")
+    first = dates.min()
+    bucket_days = (dates.max() - first).days // 500
+    if len(totals) <= TREND_MAX_POINTS or bucket_days <= 1:
+        return totals
+    # Buckets start at the first sample date, not at an epoch-aligned
+    # boundary, so the first bucket is never a partial one
+    width = pd.Timedelta(days=bucket_days)
+    buckets = (first + ((dates - first) // width) * width).rename("Date_Sample_Collected")
+    species = totals.index.get_level_values("Result_Name")
+    return totals.groupby([buckets, species], observed=True, sort=True).sum()
+
+
+# ---------------------------------------------------------------------------
+# Map markers (colours + popups built column-wise, markers added in bulk)
+# ---------------------------------------------------------------------------
+# Colour bar stops as fractions of the user-selected maximum
+VIRIDIS_COLORS = ["#641478", "#89CFF0", "#21908c", "#5dc863", "#fde725"]
+VIRIDIS_STOPS = [0, 0.2, 0.4, 0.6, 1.0]
+VIRIDIS_RGB = np.array([[int(c[i : i + 2], 16) for i in (1, 3, 5)] for c in VIRIDIS_COLORS])
+
+
+# Above this many locations per dataset, markers are clustered client-side
+CLUSTER_THRESHOLD = 500
+# FastMarkerCluster row → circle marker; rows are [lat, lon, colour, popup]
+CIRCLE_MARKER_CALLBACK = """function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+        radius: 6, color: row[2], fill: true, fillColor: row[2], fillOpacity: 0.8
+    });
+    marker.bindPopup(row[3]);
+    return marker;
+}"""
+# Unclustered layer: the same rows turned into circle markers by one script
+CIRCLE_MARKER_LAYER = """
+{% macro script(this, kwargs) %}
+    var {{ this.get_name() }} = (function () {
+        var callback = {{ this.callback }};
+        var data = {{ this.data|tojson }};
+        return L.layerGroup(data.map(callback)).addTo({{ this._parent.get_name() }});
+    })();
+{% endmacro %}"""
+
+
+def value_colors(values, vmax):
+    """
+    Hex colour per value on the 0…vmax scale (NaN → 0, clipped at vmax),
+    interpolated per RGB channel in NumPy.
+    """
+    vals = np.clip(np.nan_to_num(values), 0, vmax)
+    stops = np.asarray(VIRIDIS_STOPS) * vmax
+    r, g, b = (
+        np.rint(np.interp(vals, stops, VIRIDIS_RGB[:, k])).astype(np.int64) for k in range(3)
+    )
+    return np.char.mod("#%06x", (r << 16) | (g << 8) | b)
+
+
+def add_sample_markers(m, frame, vmax):
+    """
+    Add one circle marker per sampling location to the map: samples sharing
+    coordinates are listed in one popup, grouped under their site name, and
+    the marker takes the colour of their highest value.
+    """
+    if frame.empty:
+        return
+    frame = frame.dropna(subset=["Latitude", "Longitude"])
+    if frame.empty:
+        return
+
+    import folium
+    from folium.plugins import FastMarkerCluster
+    from folium.template import Template
+
+    vals = pd.to_numeric(frame["Result_Value_Numeric"], errors="coerce").fillna(0.0)
+
+    if "Time" in frame.columns:
+        # Loaders already hold Time as display strings
+        time_str = ("Time: " + frame["Time"].astype(str) + "<br>").where(
+            frame["Time"].notna(), ""
+        )
+    else:
+        time_str = ""
+
+    units = frame["Units"].astype(str) if "Units" in frame.columns else "cells/L"
+
+    entries = (
+        frame["Date_Sample_Collected"].dt.strftime("%Y-%m-%d").fillna("") + "<br>"
+        + time_str
+        + frame["Result_Name"].astype(str) + "<br>"
+        + vals.map("{:,.0f}".format) + " " + units
+    )
+
+    locations = (
+        pd.DataFrame(
+            {
+                "lat": frame["Latitude"].to_numpy(),
+                "lon": frame["Longitude"].to_numpy(),
+                "site": frame["Site_Description"].astype(str).to_numpy(),
+                "value": vals.to_numpy(),
+                "entry": entries.to_numpy(),
+            }
+        )
+        .groupby(["lat", "lon", "site"], sort=False)
+        .agg(value=("value", "max"), entry=("entry", "<hr>".join))
+        .reset_index()
+    )
+    # Different sites can share coordinates: each keeps its own heading
+    # inside the one popup for that location
+    locations["entry"] = "<b>" + locations["site"] + "</b><br>" + locations["entry"]
+    locations = (
+        locations.groupby(["lat", "lon"], sort=False)
+        .agg(value=("value", "max"), entry=("entry", "<hr>".join))
+        .reset_index()
+    )
+
+    # Plain floats for the JSON rows; 6 decimals (~0.1 m) drops float32 noise
+    lat = locations["lat"].to_numpy(dtype=float).round(6).tolist()
+    lon = locations["lon"].to_numpy(dtype=float).round(6).tolist()
+    colors = value_colors(locations["value"].to_numpy(), vmax)
+    popups = '<div style="max-height:240px;overflow-y:auto">' + locations["entry"] + "</div>"
+
+    rows = list(zip(lat, lon, colors.tolist(), popups.tolist()))
+
+    if len(locations) > CLUSTER_THRESHOLD:
+        # Dense selections: markers are built in the browser from plain rows
+        # and clustered until zoomed in
+        FastMarkerCluster(
+            data=rows,
+            callback=CIRCLE_MARKER_CALLBACK,
+            control=False,
+            disableClusteringAtZoom=10,
+        ).add_to(m)
+        return
+
+    # Sparse selections: one layer built from the same plain rows, instead
+    # of a folium object (and template render) per marker
+    layer = folium.MacroElement()
+    layer._name = "CircleMarkerLayer"
+    layer._template = Template(CIRCLE_MARKER_LAYER)
+    layer.data = rows
+    layer.callback = CIRCLE_MARKER_CALLBACK
+    layer.add_to(m)
+
+
+# ---------------------------------------------------------------------------
+# Map HTML (cached per filter state; the browser gets a static document)
+# ---------------------------------------------------------------------------
+def points_hash(frame):
+    if frame.empty:
+        return 0
+    cols = ["Latitude", "Longitude", "Result_Value_Numeric"]
+    return int(pd.util.hash_pandas_object(frame[cols], index=False).sum())
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def render_map_html(map_key, vmax, _sub_df, _comm_sub_df):
+    """
+    Build the folium map and return its rendered HTML. Only `map_key` and
+    `vmax` are hashed; the frames (underscored) are not.
+    """
+    import folium  # imported on first map build, not at script start
+
+    m = folium.Map(
+        location=[-34.9, 138.6],
+        zoom_start=6,
+        control_scale=True,
+        zoom_control="bottomleft",
+        # One <canvas> for all circle markers instead of an SVG node each
+        prefer_canvas=True,
+    )
+
+    folium.TileLayer(
+        tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
+        attr="Esri",
+        name="Satellite",
+        overlay=False,
+        control=True,
+    ).add_to(m)
+    folium.TileLayer(
+        tiles="https://server.arcgisonline.com/ArcGIS/rest/services/Reference/World_Boundaries_and_Places/MapServer/tile/{z}/{y}/{x}",
+        attr="Esri",
+        name="Labels",
+        overlay=True,
+        control=True,
+    ).add_to(m)
+    folium.LayerControl(position="bottomright").add_to(m)
+
+    # Community markers, then government markers on top
+    # (colour scale uses the user-selected vmax)
+    add_sample_markers(m, _comm_sub_df, vmax)
+    add_sample_markers(m, _sub_df, vmax)
+
+    # Fit bounds
+    plotted = [f for f in (_sub_df, _comm_sub_df) if not f.empty]
+    if plotted:
+        lats = np.concatenate([f["Latitude"].to_numpy(dtype=float) for f in plotted])
+        lons = np.concatenate([f["Longitude"].to_numpy(dtype=float) for f in plotted])
+        if not (np.isnan(lats).all() or np.isnan(lons).all()):
+            m.fit_bounds([[np.nanmin(lats), np.nanmin(lons)], [np.nanmax(lats), np.nanmax(lons)]])
+
+    return m.get_root().render()
+
+
 # ---------------------------------------------------------------------------
 # Main app
 # ---------------------------------------------------------------------------
@@ -337,10 +867,23 @@ def main():
     # ------------------------------------------------------------------
     # Load data
     # ------------------------------------------------------------------
-    with st.spinner("Downloading latest government data from ArcGIS… (first load or cache refresh only)"):
-        df = load_data()
-
-    community_df = load_community()
+    # Community data is only loaded while its sidebar checkbox is ticked
+    # (value from the previous run; ticked by default). On a cold cache the
+    # spreadsheet is read in a worker thread while ArcGIS downloads.
+    with ThreadPoolExecutor(
+        max_workers=1, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())
+    ) as pool:
+        community_future = None
+        if st.session_state.get("include_community", True):
+            community_future = pool.submit(load_community, COMMUNITY_FILE, file_mtime(COMMUNITY_FILE))
+
+        with st.spinner("Downloading latest government data from ArcGIS… (first load or cache refresh only)"):
+            df = load_data(int(time.time() // GOV_TTL))
+
+        if community_future is not None:
+            community_df = community_future.result()
+        else:
+            community_df = pd.DataFrame(columns=COMMUNITY_COLUMNS)
 
     # Persistent state for filters
     if "species_selected" not in st.session_state:
@@ -402,10 +945,15 @@ def main():
         # Force refresh button
         if st.button("🔄 Force refresh government data", help="Clear cache and pull the latest data from ArcGIS"):
             load_data.clear()
+            load_sites.clear()
+            try:
+                os.remove(GOV_SNAPSHOT)
+            except OSError:
+                pass
             st.rerun()
 
         # Include community data
-        include_community = st.checkbox("Include community data", value=True)
+        include_community = st.checkbox("Include community data", value=True, key="include_community")
 
         if "prev_include_community" not in st.session_state:
             st.session_state.prev_include_community = True
@@ -415,27 +963,10 @@ def main():
 
         st.markdown('<div class="sidebar-card">Filters</div>', unsafe_allow_html=True)
 
-        # Combined data for filters
-        if include_community:
-            combined_df = pd.concat([df, community_df], ignore_index=True)
-            if not combined_df.empty:
-                min_date, max_date = (
-                    combined_df["Date_Sample_Collected"].min(),
-                    combined_df["Date_Sample_Collected"].max(),
-                )
-            else:
-                min_date, max_date = pd.to_datetime("2020-01-01"), pd.to_datetime("2030-12-31")
-        else:
-            combined_df = df.copy()
-            if not df.empty:
-                min_date, max_date = (
-                    df["Date_Sample_Collected"].min(),
-                    df["Date_Sample_Collected"].max(),
-                )
-            else:
-                min_date, max_date = pd.to_datetime("2020-01-01"), pd.to_datetime("2030-12-31")
-
-        all_species = sorted(combined_df["Result_Name"].dropna().unique())
+        # Species list + date bounds for filters
+        all_species, min_date, max_date = get_filter_metadata(
+            df, community_df if include_community else community_df.iloc[0:0]
+        )
 
         if "species_multiselect" not in st.session_state:
             st.session_state["species_multiselect"] = [s for s in all_species if "Karenia" in s]
@@ -482,51 +1013,39 @@ def main():
         )
         st.session_state.species_selected = species_selected
 
-        # Date range
+        # Date range (plain dates computed once; previous choice clamped to the data)
         previous_date_range = st.session_state.date_range
-        last_week_start = max_date - timedelta(days=14)
+        min_day, max_day = min_date.date(), max_date.date()
 
         if previous_date_range and len(previous_date_range) == 2:
-            clamped_start = max(min_date.date(), min(previous_date_range[0], max_date.date()))
-            clamped_end = max(clamped_start, min(max_date.date(), previous_date_range[1]))
-            date_range = st.date_input(
-                "Date range (year/month/day format)",
-                [clamped_start, clamped_end],
-                min_value=min_date.date(),
-                max_value=max_date.date(),
-                key="date_input",
-            )
+            default_start = max(min_day, min(previous_date_range[0], max_day))
+            default_end = max(default_start, min(max_day, previous_date_range[1]))
         else:
-            date_range = st.date_input(
-                "Date range (year/month/day format)",
-                [last_week_start.date(), max_date.date()],
-                min_value=min_date.date(),
-                max_value=max_date.date(),
-                key="date_input",
-            )
+            default_start, default_end = (max_date - timedelta(days=14)).date(), max_day
+
+        date_range = st.date_input(
+            "Date range (year/month/day format)",
+            [default_start, default_end],
+            min_value=min_day,
+            max_value=max_day,
+            key="date_input",
+        )
         st.session_state.date_range = date_range
 
         if len(date_range) == 2:
-            start_date, end_date = pd.to_datetime(date_range[0]), pd.to_datetime(date_range[1])
+            start_date, end_date = pd.Timestamp(date_range[0]), pd.Timestamp(date_range[1])
         else:
             start_date, end_date = min_date, max_date
 
     # ------------------------------------------------------------------
     # Filter data
     # ------------------------------------------------------------------
-    mask_main = (
-        df["Result_Name"].isin(species_selected)
-        & df["Date_Sample_Collected"].between(start_date, end_date)
-    )
-    sub_df = df[mask_main].copy()
+    # Species rows come from a cached index, cut to the date window
+    sub_df = select_samples(df, species_selected, start_date, end_date)
 
     comm_sub_df = pd.DataFrame()
     if include_community:
-        mask_comm = (
-            community_df["Result_Name"].isin(species_selected)
-            & community_df["Date_Sample_Collected"].between(start_date, end_date)
-        )
-        comm_sub_df = community_df[mask_comm].copy()
+        comm_sub_df = select_samples(community_df, species_selected, start_date, end_date)
 
     filtered_records = len(sub_df) + len(comm_sub_df)
     st.sidebar.markdown(
@@ -559,119 +1078,16 @@ def main():
     # ------------------------------------------------------------------
     # Map
     # ------------------------------------------------------------------
-    m = folium.Map(
-        location=[-34.9, 138.6],
-        zoom_start=6,
-        control_scale=True,
-        zoom_control="bottomleft",
-    )
-
-    folium.TileLayer(
-        tiles="https://server.arcgisonline.com/ArcGIS/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}",
-        attr="Esri",
-        name="Satellite",
-        overlay=False,
-        control=True,
-    ).add_to(m)
-    folium.TileLayer(
-        tiles="https://server.arcgisonline.com/ArcGIS/rest/services/Reference/World_Boundaries_and_Places/MapServer/tile/{z}/{y}/{x}",
-        attr="Esri",
-        name="Labels",
-        overlay=True,
-        control=True,
-    ).add_to(m)
-    folium.LayerControl(position="bottomright").add_to(m)
-
-    # Colour scale now uses the user-selected vmax
-    viridis_colors = ["#641478", "#89CFF0", "#21908c", "#5dc863", "#fde725"]
-    colormap = LinearColormap(
-        colors=viridis_colors,
-        index=[0, 0.2 * vmax, 0.4 * vmax, 0.6 * vmax, vmax],
-        vmin=0,
-        vmax=vmax,
+    # Rebuilt only when the filters or the plotted points change
+    map_key = (
+        tuple(species_selected),
+        start_date,
+        end_date,
+        include_community,
+        points_hash(sub_df),
+        points_hash(comm_sub_df),
     )
-
-    # Community markers
-    for _, row in comm_sub_df.iterrows():
-        if pd.notna(row.get("Latitude")) and pd.notna(row.get("Longitude")):
-            value = row["Result_Value_Numeric"]
-            value_display = "0" if pd.isna(value) else f"{value:,.0f}"
-            color = colormap(value if pd.notna(value) else 0)
-            units = row.get("Units", "cells/L")
-
-            time_str = ""
-            if "Time" in row and pd.notna(row.get("Time")):
-                try:
-                    fractional_day = float(row["Time"])
-                    total_minutes = int(fractional_day * 1440)
-                    hours = total_minutes // 60
-                    minutes = total_minutes % 60
-                    time_str = f"Time: {hours:02d}:{minutes:02d}<br>"
-                except Exception:
-                    time_str = f"Time: {row['Time']}<br>"
-
-            folium.CircleMarker(
-                location=[row["Latitude"], row["Longitude"]],
-                radius=6,
-                color=color,
-                fill=True,
-                fill_color=color,
-                fill_opacity=0.8,
-                popup=(
-                    f"<b>{row['Site_Description']}</b><br>"
-                    f"{row['Date_Sample_Collected'].date()}<br>"
-                    f"{time_str}"
-                    f"{row['Result_Name']}<br>"
-                    f"{value_display} {units}"
-                ),
-            ).add_to(m)
-
-    # Government markers
-    for _, row in sub_df.iterrows():
-        if pd.notna(row.get("Latitude")) and pd.notna(row.get("Longitude")):
-            value = row["Result_Value_Numeric"]
-            value_display = "0" if pd.isna(value) else f"{value:,.0f}"
-            color = colormap(value if pd.notna(value) else 0)
-            units = row.get("Units", "cells/L")
-
-            time_str = ""
-            if "Time" in row and pd.notna(row.get("Time")):
-                try:
-                    fractional_day = float(row["Time"])
-                    total_minutes = int(fractional_day * 1440)
-                    hours = total_minutes // 60
-                    minutes = total_minutes % 60
-                    time_str = f"Time: {hours:02d}:{minutes:02d}<br>"
-                except Exception:
-                    time_str = f"Time: {row['Time']}<br>"
-
-            folium.CircleMarker(
-                location=[row["Latitude"], row["Longitude"]],
-                radius=6,
-                color=color,
-                fill=True,
-                fill_color=color,
-                fill_opacity=0.8,
-                popup=(
-                    f"<b>{row['Site_Description']}</b><br>"
-                    f"{row['Date_Sample_Collected'].date()}<br>"
-                    f"{time_str}"
-                    f"{row['Result_Name']}<br>"
-                    f"{value_display} {units}"
-                ),
-            ).add_to(m)
-
-    # Fit bounds
-    combined_sub = pd.concat([sub_df, comm_sub_df], ignore_index=True)
-    if not combined_sub.empty:
-        lat_min = combined_sub["Latitude"].min()
-        lon_min = combined_sub["Longitude"].min()
-        lat_max = combined_sub["Latitude"].max()
-        lon_max = combined_sub["Longitude"].max()
-        if pd.notna(lat_min) and pd.notna(lon_min) and pd.notna(lat_max) and pd.notna(lon_max):
-            m.fit_bounds([[lat_min, lon_min], [lat_max, lon_max]])
-
-    st_folium(m, width="100%", height=550)
+    components.html(render_map_html(map_key, vmax, sub_df, comm_sub_df), height=550)
 
     # ------------------------------------------------------------------
     # Trends section
@@ -683,12 +1099,11 @@ def main():
             "Include community data in trends", value=include_community
         )
 
+        trend_frames = [df]
         if include_comm_in_trends and include_community and not community_df.empty:
-            base_trends_df = pd.concat([df, community_df], ignore_index=True)
-        else:
-            base_trends_df = df.copy()
+            trend_frames.append(community_df)
 
-        all_species_trends = sorted(base_trends_df["Result_Name"].dropna().unique())
+        all_species_trends = sorted_union(trend_frames, "Result_Name")
 
         subcount = [s for s in all_species_trends if "Karenia spp subcount *" in s]
         karenia_sp = [s for s in all_species_trends if "Karenia sp." in s and "subcount" not in s]
@@ -708,65 +1123,68 @@ def main():
             default=default_trend_species,
         )
 
-        all_sites = sorted(base_trends_df["Site_Description"].dropna().unique())
+        all_sites = sorted_union(trend_frames, "Site_Description")
         selected_site = st.selectbox(
             "Filter by site", options=["All Sites"] + all_sites, index=0
         )
 
-        plot_df = base_trends_df[
-            (base_trends_df["Result_Name"].isin(selected_trend_species))
-            & (base_trends_df["Result_Value_Numeric"].notna())
-        ].copy()
+        # Work from the cached daily rollups; only the selected species'
+        # rows are pulled out of each source and concatenated
+        plot_df = concat_categorical(
+            rollup[species_mask(rollup, selected_trend_species)]
+            for rollup in map(daily_rollup, trend_frames)
+        )
 
         if selected_site != "All Sites":
             plot_df = plot_df[plot_df["Site_Description"] == selected_site]
 
-        plot_df = plot_df.sort_values("Date_Sample_Collected")
+        n_points = int(plot_df["count"].sum())
 
         if not plot_df.empty:
-            trend_df = plot_df.pivot_table(
-                index="Date_Sample_Collected",
-                columns="Result_Name",
-                values="Result_Value_Numeric",
-                aggfunc="mean",
-            ).reset_index()
-
-            trend_melted = trend_df.melt(
-                id_vars="Date_Sample_Collected",
-                var_name="Species",
-                value_name="Cell_Count",
-                ignore_index=False,
+            # Mean per date and species (pooled over sites when 'All Sites')
+            totals = plot_df.groupby(["Date_Sample_Collected", "Result_Name"], observed=True, sort=True)[
+                ["sum", "count"]
+            ].sum()
+            totals = coarsen_trend(totals)
+            trend_melted = (
+                (totals["sum"] / totals["count"])
+                .rename("Cell_Count")
+                .reset_index()
+                .rename(columns={"Result_Name": "Species"})
             )
 
-            base = (
-                alt.Chart(trend_melted)
-                .mark_line(point=True)
-                .encode(
-                    x=alt.X(
-                        "Date_Sample_Collected:T",
-                        title="Date",
-                        axis=alt.Axis(labelAngle=0, format="%d %b %Y"),
-                    ),
-                    y=alt.Y("Cell_Count:Q", title="Cell Count per L"),
-                    color=alt.Color("Species:N", title="Species"),
-                    tooltip=["Date_Sample_Collected", "Species", "Cell_Count"],
-                )
-                .properties(
-                    width=800,
-                    height=400,
-                    title=alt.TitleParams(
-                        text="Trends for selected species (note: average values will be displayed if 'All Sites' selected, *denotes community data)",
-                        fontSize=14,
-                        fontWeight="normal",
-                        color="#4c4c4c",
-                    ),
-                )
-                .interactive()
-            )
-            st.altair_chart(base, use_container_width=True)
+            # Plain Vega-Lite spec: skips Altair's object model and schema validation
+            spec = {
+                "mark": {"type": "line", "point": True},
+                "encoding": {
+                    "x": {
+                        "field": "Date_Sample_Collected",
+                        "type": "temporal",
+                        "title": "Date",
+                        "axis": {"labelAngle": 0, "format": "%d %b %Y"},
+                    },
+                    "y": {"field": "Cell_Count", "type": "quantitative", "title": "Cell Count per L"},
+                    "color": {"field": "Species", "type": "nominal", "title": "Species"},
+                    "tooltip": [
+                        {"field": "Date_Sample_Collected", "type": "temporal"},
+                        {"field": "Species", "type": "nominal"},
+                        {"field": "Cell_Count", "type": "quantitative"},
+                    ],
+                },
+                "params": [{"name": "grid", "select": "interval", "bind": "scales"}],
+                "width": 800,
+                "height": 400,
+                "title": {
+                    "text": "Trends for selected species (note: average values will be displayed if 'All Sites' selected, *denotes community data)",
+                    "fontSize": 14,
+                    "fontWeight": "normal",
+                    "color": "#4c4c4c",
+                },
+            }
+            st.vega_lite_chart(trend_melted, spec, use_container_width=True)
 
             st.caption(
-                f"Showing {len(plot_df)} data points across {len(selected_trend_species)} species "
+                f"Showing {n_points} data points across {len(selected_trend_species)} species "
                 f"and {'all sites' if selected_site == 'All Sites' else selected_site}."
             )
         else: